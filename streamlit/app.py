@@ -3,13 +3,56 @@ import pandas as pd
 import numpy as np
 import altair as alt
 from datetime import datetime, timedelta
-import plotly.express as px
+import plotly.graph_objects as go
 import json
 from database import BudgetDatabase
 from auth_manager import AuthManager
 
-# Initialize authentication manager
-auth = AuthManager()
+@st.cache_resource
+def get_auth():
+    """Shared authentication manager, reused across reruns"""
+    return AuthManager()
+
+@st.cache_resource(max_entries=64)
+def get_db(user_id):
+    """Per-user database handle, reused across reruns; evicted handles close
+    their connection once garbage collected"""
+    return BudgetDatabase(user_id=user_id, auth_manager=get_auth())
+
+# Maximum rows sent to the browser in the Transaction Details table
+TRANSACTION_DISPLAY_LIMIT = 500
+
+@st.cache_data(ttl=300)
+def cached_transactions(user_id, start_date, end_date, version, limit=None):
+    """Decrypted transactions, recomputed only when the data version changes"""
+    return get_db(user_id).get_transactions(start_date, end_date, limit)
+
+@st.cache_data(ttl=300)
+def cached_category_totals(user_id, start_date, end_date, version):
+    """Category totals over the full range, independent of the display limit"""
+    return get_db(user_id).get_category_totals(start_date, end_date)
+
+def clear_transaction_caches():
+    """Drop cached transaction data after a write; the version key alone can repeat after a restore"""
+    cached_transactions.clear()
+    cached_category_totals.clear()
+
+@st.cache_data
+def build_pie_chart(labels, values, title):
+    """Spending distribution figure, rebuilt only when its inputs change"""
+    fig = go.Figure(go.Pie(labels=labels, values=values, sort=False))
+    fig.update_layout(title=title, transition_duration=0, uirevision='pie')
+    return fig
+
+@st.cache_data
+def build_comparison_chart(categories, allocated, spent, title):
+    """Budget vs. actual figure, rebuilt only when its inputs change"""
+    fig = go.Figure([
+        go.Bar(name='Allocated', x=categories, y=allocated),
+        go.Bar(name='Spent', x=categories, y=spent)
+    ])
+    fig.update_layout(title=title, barmode='group', uirevision='comparison')
+    return fig
 
 # Initialize session state
 if 'authenticated' not in st.session_state:
@@ -27,6 +70,9 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Initialize authentication manager
+auth = get_auth()
+
 def login_page():
     st.title("Welcome to Budget Planner")
     
@@ -97,7 +143,7 @@ def login_page():
 
 def main_app():
     # Initialize database with user_id
-    db = BudgetDatabase(user_id=st.session_state.user_id)
+    db = get_db(st.session_state.user_id)
     
     # Sidebar navigation
     st.sidebar.title("💰 Budget Planner")
@@ -141,11 +187,11 @@ def main_app():
 
             # Show recent transactions
             st.subheader("Recent Transactions")
-            recent_transactions = db.get_transactions()
-            if recent_transactions:
-                df = pd.DataFrame(recent_transactions)
+            recent_transactions = db.get_recent_transactions()
+            if not recent_transactions.empty:
                 st.dataframe(
-                    df[['date', 'amount', 'category', 'description']],
+                    recent_transactions,
+                    column_config={'date': st.column_config.DateColumn('date')},
                     use_container_width=True
                 )
             else:
@@ -178,68 +224,11 @@ def main_app():
             
             if st.form_submit_button("Add Transaction"):
                 db.add_transaction(date, amount, category, description)
+                clear_transaction_caches()
                 st.success("Transaction added successfully!")
 
     elif app_mode == "Reports":
-        st.title("Budget Reports")
-        
-        report_period = st.selectbox("Select Report Period", ["Weekly", "Monthly", "Yearly"])
-        start_date, end_date = get_date_range(report_period)
-        
-        transactions = db.get_transactions(start_date, end_date)
-        
-        if transactions:
-            category_totals = db.get_category_totals(start_date, end_date)
-            
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                st.subheader("Spending Distribution")
-                fig = px.pie(
-                    values=list(category_totals.values()),
-                    names=list(category_totals.keys()),
-                    title=f"{report_period} Spending by Category"
-                )
-                st.plotly_chart(fig, use_container_width=True)
-            
-            with col2:
-                st.subheader("Budget vs. Actual")
-                period_factor = 1
-                if report_period == "Weekly":
-                    period_factor = 7/30
-                elif report_period == "Yearly":
-                    period_factor = 12
-                
-                current_salary = db.get_salary()
-                period_allocation = calculate_allocation(current_salary * period_factor)
-                
-                comparison_data = pd.DataFrame({
-                    'Category': list(period_allocation.keys()),
-                    'Allocated': list(period_allocation.values()),
-                    'Spent': [
-                        category_totals.get('Needs', 0),
-                        category_totals.get('Wants', 0),
-                        category_totals.get('Savings', 0)
-                    ]
-                })
-                
-                fig = px.bar(
-                    comparison_data,
-                    x='Category',
-                    y=['Allocated', 'Spent'],
-                    title=f"{report_period} Budget vs. Actual Spending",
-                    barmode='group'
-                )
-                st.plotly_chart(fig, use_container_width=True)
-            
-            st.subheader("Transaction Details")
-            df = pd.DataFrame(transactions)
-            st.dataframe(
-                df[['date', 'amount', 'category', 'description']].sort_values('date', ascending=False),
-                use_container_width=True
-            )
-        else:
-            st.info(f"No transactions found for the selected {report_period.lower()} period.")
+        reports_page(db)
 
     elif app_mode == "Backup & Restore":
         st.title("Backup & Restore")
@@ -277,12 +266,72 @@ def main_app():
                 if selected_backup:
                     if st.button("Restore Selected Backup"):
                         if db.import_database(selected_backup['path']):
+                            clear_transaction_caches()
                             st.success("Backup restored successfully!")
                         else:
                             st.error("Error restoring backup")
         else:
             st.info("No backups available yet. Create a backup using the button above.")
 
+@st.fragment
+def reports_page(db):
+    """Reports page; reruns on its own when the period or display options change"""
+    st.title("Budget Reports")
+    
+    report_period = st.selectbox("Select Report Period", ["Weekly", "Monthly", "Yearly"])
+    start_date, end_date = get_date_range(report_period)
+    
+    show_all = st.checkbox("Show all transactions", value=False)
+    limit = None if show_all else TRANSACTION_DISPLAY_LIMIT
+    
+    version = db.get_transactions_version()
+    transactions = cached_transactions(db.user_id, start_date, end_date, version, limit)
+    
+    if not transactions.empty:
+        category_totals = cached_category_totals(db.user_id, start_date, end_date, version)
+        
+        col1, col2 = st.columns(2)
+        
+        with col1:
+            st.subheader("Spending Distribution")
+            fig = build_pie_chart(
+                tuple(category_totals.index),
+                tuple(category_totals.to_numpy()),
+                f"{report_period} Spending by Category"
+            )
+            st.plotly_chart(fig, use_container_width=True)
+        
+        with col2:
+            st.subheader("Budget vs. Actual")
+            period_factor = 1
+            if report_period == "Weekly":
+                period_factor = 7/30
+            elif report_period == "Yearly":
+                period_factor = 12
+            
+            current_salary = db.get_salary()
+            period_allocation = calculate_allocation(current_salary * period_factor)
+            categories = tuple(period_allocation.keys())
+            
+            fig = build_comparison_chart(
+                categories,
+                tuple(period_allocation.values()),
+                tuple(category_totals.reindex(categories, fill_value=0.0).to_numpy()),
+                f"{report_period} Budget vs. Actual Spending"
+            )
+            st.plotly_chart(fig, use_container_width=True)
+        
+        st.subheader("Transaction Details")
+        if limit is not None and len(transactions) == limit:
+            st.caption(f"Showing the {limit} most recent transactions.")
+        st.dataframe(
+            transactions,
+            column_config={'date': st.column_config.DateColumn('date')},
+            use_container_width=True
+        )
+    else:
+        st.info(f"No transactions found for the selected {report_period.lower()} period.")
+
 def calculate_allocation(salary: float):
     """Calculate budget allocation based on 50/30/20 rule"""
     if salary < 0:
@@ -1,12 +1,33 @@
 import bcrypt
 import jwt
 import sqlite3
+import threading
 from datetime import datetime, timedelta
 import secrets
 import os
+import struct
+import time
+from functools import lru_cache
 from cryptography.fernet import Fernet
 from pathlib import Path
 
+# Encrypted amounts are a NUL pad byte followed by a little-endian double; the
+# leading NUL tells them apart from older rows that stored str(amount)
+AMOUNT_CODEC = struct.Struct('<xd')
+
+def open_connection(path):
+    """Open the single long-lived SQLite connection an instance uses for all calls.
+
+    Streamlit runs scripts on several threads, so the connection may be used
+    from any of them; callers serialize access with their own lock. WAL with
+    synchronous=NORMAL turns each commit into one log append.
+    """
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
 class AuthManager:
     def __init__(self, db_path="users.db"):
         self.db_path = db_path
@@ -22,44 +43,64 @@ class AuthManager:
         
         self.fernet = Fernet(self.encryption_key)
         self.jwt_secret = os.environ.get('JWT_SECRET', secrets.token_hex(32))
+        self.bcrypt_rounds = int(os.environ.get('BCRYPT_ROUNDS', 12))
+        # One configured encoder/decoder reused for every token; expiry is
+        # checked in verify_token because decoded payloads are memoized
+        self._jwt = jwt.PyJWT(options={'verify_exp': False})
+        # Signature checks depend only on token and secret, so memoize them
+        self._decode_token = lru_cache(maxsize=1024)(
+            lambda token: self._jwt.decode(token, self.jwt_secret, algorithms=['HS256'])
+        )
+
+        self._lock = threading.Lock()
+        # Failed login counts per user id, persisted only when an account locks
+        self._fails = {}
+        self.conn = open_connection(self.db_path)
         self.init_db()
 
+        # Mirror of unexpired session tokens and their expiry (UTC) so
+        # verify_token skips the database
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute("SELECT token, expires_at FROM sessions WHERE expires_at > ?", (datetime.utcnow(),))
+            self._sessions = {token: datetime.fromisoformat(expires_at)
+                              for token, expires_at in c.fetchall()}
+
     def init_db(self):
         """Initialize the users database"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        # Create users table with security questions
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users
-            (id INTEGER PRIMARY KEY,
-             username TEXT UNIQUE NOT NULL,
-             password_hash TEXT NOT NULL,
-             email TEXT UNIQUE NOT NULL,
-             security_question TEXT NOT NULL,
-             security_answer_hash TEXT NOT NULL,
-             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-             last_login TIMESTAMP,
-             failed_attempts INTEGER DEFAULT 0,
-             locked_until TIMESTAMP)
-        ''')
-        
-        # Create session table
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS sessions
-            (id INTEGER PRIMARY KEY,
-             user_id INTEGER,
-             token TEXT NOT NULL,
-             expires_at TIMESTAMP,
-             FOREIGN KEY(user_id) REFERENCES users(id))
-        ''')
-        
-        conn.commit()
-        conn.close()
+        with self._lock, self.conn:
+            c = self.conn.cursor()
+            
+            # Create users table with security questions
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS users
+                (id INTEGER PRIMARY KEY,
+                 username TEXT UNIQUE NOT NULL,
+                 password_hash TEXT NOT NULL,
+                 email TEXT UNIQUE NOT NULL,
+                 security_question TEXT NOT NULL,
+                 security_answer_hash TEXT NOT NULL,
+                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                 last_login TIMESTAMP,
+                 failed_attempts INTEGER DEFAULT 0,
+                 locked_until TIMESTAMP)
+            ''')
+            
+            # Create session table
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS sessions
+                (id INTEGER PRIMARY KEY,
+                 user_id INTEGER,
+                 token TEXT NOT NULL,
+                 expires_at TIMESTAMP,
+                 FOREIGN KEY(user_id) REFERENCES users(id))
+            ''')
+            
+            c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_token ON sessions(token)")
 
     def hash_password(self, password: str) -> bytes:
         """Hash a password using bcrypt"""
-        return bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=self.bcrypt_rounds))
 
     def verify_password(self, password: str, password_hash: bytes) -> bool:
         """Verify a password against its hash"""
@@ -68,103 +109,101 @@ class AuthManager:
     def create_user(self, username: str, password: str, email: str, 
                    security_question: str, security_answer: str) -> bool:
         """Create a new user with security question"""
+        # Hash password and security answer
+        password_hash = self.hash_password(password)
+        answer_hash = self.hash_password(security_answer.lower())
+        
         try:
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
-            
-            # Hash password and security answer
-            password_hash = self.hash_password(password)
-            answer_hash = self.hash_password(security_answer.lower())
-            
-            c.execute("""
-                INSERT INTO users 
-                (username, password_hash, email, security_question, security_answer_hash)
-                VALUES (?, ?, ?, ?, ?)
-            """, (username, password_hash, email, security_question, answer_hash))
-            
-            conn.commit()
-            conn.close()
+            with self._lock, self.conn:
+                self.conn.execute("""
+                    INSERT INTO users 
+                    (username, password_hash, email, security_question, security_answer_hash)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (username, password_hash, email, security_question, answer_hash))
             return True
         except sqlite3.IntegrityError:
             return False
 
     def login(self, username: str, password: str) -> tuple:
         """Login a user and return JWT token if successful"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        c.execute("SELECT * FROM users WHERE username = ?", (username,))
-        user = c.fetchone()
+        with self._lock:
+            c = self.conn.cursor()
+            c.row_factory = sqlite3.Row
+            c.execute("""
+                SELECT id, username, password_hash, failed_attempts, locked_until
+                FROM users WHERE username = ?
+            """, (username,))
+            user = c.fetchone()
         
         if not user:
-            conn.close()
             return False, "Invalid username or password"
         
         # Check if account is locked
-        if user[9] and datetime.now() < datetime.fromisoformat(user[9]):
-            conn.close()
+        if user['locked_until'] and datetime.now() < datetime.fromisoformat(user['locked_until']):
             return False, "Account is locked. Try again later."
         
-        if not self.verify_password(password, user[2]):
-            # Increment failed attempts
-            failed_attempts = user[8] + 1
-            locked_until = None
+        if not self.verify_password(password, user['password_hash']):
+            # Increment failed attempts in memory, starting from the stored count
+            with self._lock:
+                failed_attempts = self._fails.get(user['id'], user['failed_attempts']) + 1
+                self._fails[user['id']] = failed_attempts
             
             if failed_attempts >= 5:
                 # Lock account for 30 minutes after 5 failed attempts
                 locked_until = datetime.now() + timedelta(minutes=30)
-            
-            c.execute("""
-                UPDATE users 
-                SET failed_attempts = ?, locked_until = ?
-                WHERE id = ?
-            """, (failed_attempts, locked_until, user[0]))
-            
-            conn.commit()
-            conn.close()
+                with self._lock, self.conn:
+                    self._fails.pop(user['id'], None)
+                    self.conn.execute("""
+                        UPDATE users 
+                        SET failed_attempts = ?, locked_until = ?
+                        WHERE id = ?
+                    """, (failed_attempts, locked_until, user['id']))
             return False, "Invalid username or password"
         
-        # Reset failed attempts on successful login
-        c.execute("""
-            UPDATE users 
-            SET failed_attempts = 0, locked_until = NULL, last_login = ?
-            WHERE id = ?
-        """, (datetime.now(), user[0]))
-        
         # Generate JWT token
-        token = jwt.encode({
-            'user_id': user[0],
-            'username': user[1],
+        token = self._jwt.encode({
+            'user_id': user['id'],
+            'username': user['username'],
             'exp': datetime.utcnow() + timedelta(hours=24)
         }, self.jwt_secret, algorithm='HS256')
         
-        # Store session
-        c.execute("""
-            INSERT INTO sessions (user_id, token, expires_at)
-            VALUES (?, ?, ?)
-        """, (user[0], token, datetime.utcnow() + timedelta(hours=24)))
-        
-        conn.commit()
-        conn.close()
+        with self._lock, self.conn:
+            c = self.conn.cursor()
+            self._fails.pop(user['id'], None)
+            
+            # Reset failed attempts on successful login
+            c.execute("""
+                UPDATE users 
+                SET failed_attempts = 0, locked_until = NULL, last_login = ?
+                WHERE id = ?
+            """, (datetime.now(), user['id']))
+            
+            # Store session
+            now = datetime.utcnow()
+            expires_at = now + timedelta(hours=24)
+            c.execute("""
+                INSERT INTO sessions (user_id, token, expires_at)
+                VALUES (?, ?, ?)
+            """, (user['id'], token, expires_at))
+            
+            # Forget expired sessions so the in-memory mirror stays bounded
+            self._sessions = {t: e for t, e in self._sessions.items() if e > now}
+            self._sessions[token] = expires_at
         
         return True, token
 
     def verify_token(self, token: str) -> tuple:
         """Verify a JWT token"""
         try:
-            payload = jwt.decode(token, self.jwt_secret, algorithms=['HS256'])
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
-            
-            c.execute("SELECT * FROM sessions WHERE token = ? AND expires_at > ?", 
-                     (token, datetime.utcnow()))
-            session = c.fetchone()
-            
-            if not session:
-                conn.close()
+            # Expiry is enforced by the JWT 'exp' claim, which matches the session lifetime
+            payload = self._decode_token(token)
+            if 'exp' in payload and payload['exp'] <= time.time():
+                with self._lock:
+                    self._sessions.pop(token, None)
+                raise jwt.ExpiredSignatureError("Signature has expired")
+            if token not in self._sessions:
                 return False, None
                 
-            conn.close()
             return True, payload
         except jwt.ExpiredSignatureError:
             return False, "Token has expired"
@@ -173,27 +212,23 @@ class AuthManager:
 
     def reset_password(self, username: str, security_answer: str, new_password: str) -> bool:
         """Reset password using security question"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        c.execute("SELECT * FROM users WHERE username = ?", (username,))
-        user = c.fetchone()
+        with self._lock:
+            c = self.conn.cursor()
+            c.row_factory = sqlite3.Row
+            c.execute("SELECT id, security_answer_hash FROM users WHERE username = ?", (username,))
+            user = c.fetchone()
         
         if not user:
-            conn.close()
             return False
         
-        if not self.verify_password(security_answer.lower(), user[5]):
-            conn.close()
+        if not self.verify_password(security_answer.lower(), user['security_answer_hash']):
             return False
         
         # Update password
         new_password_hash = self.hash_password(new_password)
-        c.execute("UPDATE users SET password_hash = ? WHERE id = ?", 
-                 (new_password_hash, user[0]))
-        
-        conn.commit()
-        conn.close()
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", 
+                             (new_password_hash, user['id']))
         return True
 
     def encrypt_data(self, data: str) -> bytes:
@@ -204,13 +239,20 @@ class AuthManager:
         """Decrypt sensitive data"""
         return self.fernet.decrypt(encrypted_data).decode()
 
+    def encrypt_amount(self, amount: float) -> bytes:
+        """Encrypt a monetary amount in compact binary form"""
+        return self.fernet.encrypt(AMOUNT_CODEC.pack(amount))
+
+    def decrypt_amount(self, encrypted_amount: bytes) -> float:
+        """Decrypt a monetary amount, accepting both binary and legacy text form"""
+        data = self.fernet.decrypt(encrypted_amount)
+        if len(data) == AMOUNT_CODEC.size and data[0] == 0:
+            return AMOUNT_CODEC.unpack(data)[0]
+        return float(data)
+
     def logout(self, token: str) -> bool:
         """Logout user by invalidating their session"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        c.execute("DELETE FROM sessions WHERE token = ?", (token,))
-        
-        conn.commit()
-        conn.close()
+        with self._lock, self.conn:
+            self._sessions.pop(token, None)
+            self.conn.execute("DELETE FROM sessions WHERE token = ?", (token,))
         return True
@@ -1,80 +1,119 @@
 import sqlite3
 import json
+import numpy as np
+import pandas as pd
+import threading
 from datetime import datetime
 import os
+import re
 import shutil
-from auth_manager import AuthManager
+import tempfile
+from auth_manager import AuthManager, open_connection
+
+# Every SQLite database file starts with this header
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+# Default backup file names, as written by export_database
+BACKUP_FILENAME = re.compile(r"^budget_backup_(\d+)_\d{8}_\d{6}\.db$")
 
 class BudgetDatabase:
-    def __init__(self, db_name="budget.db", user_id=None):
+    def __init__(self, db_name="budget.db", user_id=None, auth_manager=None):
         self.db_name = db_name
         self.user_id = user_id
-        self.auth_manager = AuthManager()
+        # Reuse a shared AuthManager when given to avoid re-reading the key file
+        self.auth_manager = auth_manager or AuthManager()
         self.backup_dir = "backups"
         if not os.path.exists(self.backup_dir):
             os.makedirs(self.backup_dir)
+
+        self._lock = threading.Lock()
+        self.conn = open_connection(self.db_name)
         self.init_database()
 
     def init_database(self):
         """Initialize the database with required tables"""
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-
-        # Create salary table with user_id
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS salary
-            (id INTEGER PRIMARY KEY,
-             user_id INTEGER NOT NULL,
-             amount_encrypted BLOB NOT NULL,
-             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
-        ''')
-
-        # Create transactions table with user_id
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS transactions
-            (id INTEGER PRIMARY KEY,
-             user_id INTEGER NOT NULL,
-             date DATE NOT NULL,
-             amount_encrypted BLOB NOT NULL,
-             category TEXT NOT NULL,
-             description_encrypted BLOB,
-             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
-        ''')
-
-        conn.commit()
-        conn.close()
+        with self._lock, self.conn:
+            c = self.conn.cursor()
+
+            # Create salary table with user_id
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS salary
+                (id INTEGER PRIMARY KEY,
+                 user_id INTEGER NOT NULL,
+                 amount_encrypted BLOB NOT NULL,
+                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+            ''')
+
+            # Create transactions table with user_id
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS transactions
+                (id INTEGER PRIMARY KEY,
+                 user_id INTEGER NOT NULL,
+                 date DATE NOT NULL,
+                 amount_encrypted BLOB NOT NULL,
+                 category TEXT NOT NULL,
+                 description_encrypted BLOB,
+                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+            ''')
+
+            # Serve per-user date range queries and their ordering from one index
+            c.execute("CREATE INDEX IF NOT EXISTS idx_trans_user_date ON transactions(user_id, date DESC)")
+
+            # Create backups table so listing backups needs no directory scan.
+            # The existence check, creation and import share one write
+            # transaction so concurrent first starts register files only once
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'backups'")
+            backups_table_exists = c.fetchone() is not None
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS backups
+                (id INTEGER PRIMARY KEY,
+                 user_id INTEGER NOT NULL,
+                 filename TEXT NOT NULL,
+                 path TEXT NOT NULL UNIQUE,
+                 created_at TIMESTAMP NOT NULL)
+            ''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_backups_user_created ON backups(user_id, created_at DESC)")
+
+            # Register backups written before the table existed
+            if not backups_table_exists:
+                for file in os.listdir(self.backup_dir):
+                    match = BACKUP_FILENAME.match(file)
+                    if match:
+                        backup_path = os.path.join(self.backup_dir, file)
+                        c.execute("""
+                            INSERT INTO backups (user_id, filename, path, created_at)
+                            VALUES (?, ?, ?, ?)
+                        """, (int(match.group(1)), file, backup_path,
+                              datetime.fromtimestamp(os.path.getmtime(backup_path))))
 
     def update_salary(self, amount):
         """Update the monthly salary"""
         if not self.user_id:
             raise ValueError("User not authenticated")
             
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
         # Encrypt the salary amount
-        encrypted_amount = self.auth_manager.encrypt_data(str(amount))
-        c.execute("DELETE FROM salary WHERE user_id = ?", (self.user_id,))
-        c.execute("INSERT INTO salary (user_id, amount_encrypted) VALUES (?, ?)", 
-                 (self.user_id, encrypted_amount))
-        conn.commit()
-        conn.close()
+        encrypted_amount = self.auth_manager.encrypt_amount(amount)
+        with self._lock, self.conn:
+            c = self.conn.cursor()
+            c.execute("DELETE FROM salary WHERE user_id = ?", (self.user_id,))
+            c.execute("INSERT INTO salary (user_id, amount_encrypted) VALUES (?, ?)", 
+                     (self.user_id, encrypted_amount))
 
     def get_salary(self):
         """Get the current monthly salary"""
         if not self.user_id:
             raise ValueError("User not authenticated")
             
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-        c.execute("SELECT amount_encrypted FROM salary WHERE user_id = ? ORDER BY updated_at DESC LIMIT 1", 
-                 (self.user_id,))
-        result = c.fetchone()
-        conn.close()
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute("SELECT amount_encrypted FROM salary WHERE user_id = ? ORDER BY updated_at DESC LIMIT 1", 
+                     (self.user_id,))
+            result = c.fetchone()
         
         if result:
             # Decrypt the salary amount
-            decrypted_amount = self.auth_manager.decrypt_data(result[0])
-            return float(decrypted_amount)
+            return self.auth_manager.decrypt_amount(result[0])
         return 0.0
 
     def add_transaction(self, date, amount, category, description=""):
@@ -82,32 +121,29 @@ class BudgetDatabase:
         if not self.user_id:
             raise ValueError("User not authenticated")
             
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-        
         # Encrypt sensitive data
-        encrypted_amount = self.auth_manager.encrypt_data(str(amount))
+        encrypted_amount = self.auth_manager.encrypt_amount(amount)
         encrypted_description = self.auth_manager.encrypt_data(description)
         
-        c.execute("""
-            INSERT INTO transactions 
-            (user_id, date, amount_encrypted, category, description_encrypted)
-            VALUES (?, ?, ?, ?, ?)
-        """, (self.user_id, date, encrypted_amount, category, encrypted_description))
-        
-        conn.commit()
-        conn.close()
+        with self._lock, self.conn:
+            self.conn.execute("""
+                INSERT INTO transactions 
+                (user_id, date, amount_encrypted, category, description_encrypted)
+                VALUES (?, ?, ?, ?, ?)
+            """, (self.user_id, date, encrypted_amount, category, encrypted_description))
 
-    def get_transactions(self, start_date=None, end_date=None):
-        """Get transactions within a date range"""
+    def get_transactions(self, start_date=None, end_date=None, limit=None):
+        """Get transactions within a date range, newest first, optionally capped at limit rows.
+
+        Returns a DataFrame with columns date, amount, category, description.
+        """
         if not self.user_id:
             raise ValueError("User not authenticated")
             
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        
-        query = "SELECT * FROM transactions WHERE user_id = ?"
+        query = """
+            SELECT date, amount_encrypted, category, description_encrypted
+            FROM transactions WHERE user_id = ?
+        """
         params = [self.user_id]
         
         if start_date and end_date:
@@ -116,35 +152,73 @@ class BudgetDatabase:
         
         query += " ORDER BY date DESC"
         
-        c.execute(query, params)
-        encrypted_transactions = c.fetchall()
-        conn.close()
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        
+        with self._lock:
+            transactions = pd.read_sql_query(query, self.conn, params=params, parse_dates=['date'])
         
-        # Decrypt transactions
-        transactions = []
-        for trans in encrypted_transactions:
-            decrypted_trans = dict(trans)
-            decrypted_trans['amount'] = float(self.auth_manager.decrypt_data(trans['amount_encrypted']))
-            decrypted_trans['description'] = self.auth_manager.decrypt_data(trans['description_encrypted'])
-            transactions.append(decrypted_trans)
+        # Decrypt the encrypted columns in place, keeping the column order
+        decrypt_amount = self.auth_manager.decrypt_amount
+        decrypt_data = self.auth_manager.decrypt_data
+        transactions['amount_encrypted'] = np.fromiter(
+            (decrypt_amount(value) for value in transactions['amount_encrypted']),
+            dtype=float, count=len(transactions)
+        )
+        transactions['description_encrypted'] = [
+            decrypt_data(value) for value in transactions['description_encrypted']
+        ]
         
-        return transactions
+        return transactions.rename(columns={
+            'amount_encrypted': 'amount',
+            'description_encrypted': 'description'
+        })
+
+    def get_recent_transactions(self, limit=10):
+        """Get the most recent transactions, decrypting only the returned rows"""
+        return self.get_transactions(limit=limit)
+
+    def get_transactions_version(self):
+        """Cheap fingerprint of the user's transactions; rowids can be reused after a
+        restore, so it may repeat and callers should not rely on it alone"""
+        if not self.user_id:
+            raise ValueError("User not authenticated")
+            
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM transactions WHERE user_id = ?", 
+                     (self.user_id,))
+            return c.fetchone()
 
     def get_category_totals(self, start_date=None, end_date=None):
-        """Get total spending by category within a date range"""
+        """Get total spending by category within a date range, as a Series indexed by category"""
         if not self.user_id:
             raise ValueError("User not authenticated")
             
-        transactions = self.get_transactions(start_date, end_date)
-        totals = {}
-        for trans in transactions:
-            category = trans['category']
-            amount = trans['amount']
-            totals[category] = totals.get(category, 0) + amount
-        return totals
+        # Only amounts are needed here, so skip decrypting descriptions
+        query = "SELECT category, amount_encrypted FROM transactions WHERE user_id = ?"
+        params = [self.user_id]
+        
+        if start_date and end_date:
+            query += " AND date BETWEEN ? AND ?"
+            params.extend([start_date, end_date])
+        
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute(query, params)
+            rows = c.fetchall()
+        
+        # Decrypt the amount column in one pass and let pandas do the grouping
+        totals = pd.DataFrame(rows, columns=['category', 'amount'])
+        totals['amount'] = np.fromiter(
+            (self.auth_manager.decrypt_amount(value) for value in totals['amount']),
+            dtype=float, count=len(totals)
+        )
+        return totals.groupby('category')['amount'].sum()
 
     def export_database(self, backup_name=None):
-        """Export the database to a backup file"""
+        """Export the current user's data to an encrypted backup file"""
         if not self.user_id:
             raise ValueError("User not authenticated")
             
@@ -153,19 +227,38 @@ class BudgetDatabase:
         
         backup_path = os.path.join(self.backup_dir, backup_name)
         
-        # Create an encrypted backup
-        data = {
-            'salary': self.get_salary(),
-            'transactions': self.get_transactions()
-        }
+        # Copy this user's rows, still encrypted, into a standalone SQLite file
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_path = os.path.join(tmp_dir, "snapshot.db")
+            with self._lock:
+                self.conn.execute("ATTACH DATABASE ? AS snapshot", (snapshot_path,))
+                try:
+                    with self.conn:
+                        c = self.conn.cursor()
+                        c.execute("CREATE TABLE snapshot.salary AS SELECT * FROM salary WHERE user_id = ?", 
+                                 (self.user_id,))
+                        c.execute("CREATE TABLE snapshot.transactions AS SELECT * FROM transactions WHERE user_id = ?", 
+                                 (self.user_id,))
+                finally:
+                    self.conn.execute("DETACH DATABASE snapshot")
+            
+            with open(snapshot_path, 'rb') as f:
+                snapshot = f.read()
         
-        # Encrypt the entire backup
-        encrypted_data = self.auth_manager.encrypt_data(json.dumps(data))
+        # Encrypt the entire snapshot as a single blob
+        encrypted_data = self.auth_manager.fernet.encrypt(snapshot)
         
         # Save encrypted backup
         with open(backup_path, 'wb') as f:
             f.write(encrypted_data)
         
+        # A second backup in the same second overwrites the file, so replace its row too
+        with self._lock, self.conn:
+            self.conn.execute("""
+                INSERT OR REPLACE INTO backups (user_id, filename, path, created_at)
+                VALUES (?, ?, ?, ?)
+            """, (self.user_id, backup_name, backup_path, datetime.now()))
+        
         return backup_path
 
     def import_database(self, backup_path):
@@ -173,53 +266,105 @@ class BudgetDatabase:
         if not self.user_id:
             raise ValueError("User not authenticated")
             
+        # The backups table is the source of truth; forget entries whose file is gone
+        if not os.path.exists(backup_path):
+            with self._lock, self.conn:
+                self.conn.execute("DELETE FROM backups WHERE user_id = ? AND path = ?", 
+                                 (self.user_id, backup_path))
+            print(f"Error importing backup: {backup_path} not found")
+            return False
+            
         try:
             # Read and decrypt backup
             with open(backup_path, 'rb') as f:
                 encrypted_data = f.read()
             
-            decrypted_data = self.auth_manager.decrypt_data(encrypted_data)
-            data = json.loads(decrypted_data)
-            
-            # Clear existing data for this user
-            conn = sqlite3.connect(self.db_name)
-            c = conn.cursor()
-            c.execute("DELETE FROM salary WHERE user_id = ?", (self.user_id,))
-            c.execute("DELETE FROM transactions WHERE user_id = ?", (self.user_id,))
-            conn.commit()
-            conn.close()
+            decrypted_data = self.auth_manager.fernet.decrypt(encrypted_data)
             
-            # Import salary
-            if data['salary']:
-                self.update_salary(float(data['salary']))
-            
-            # Import transactions
-            for trans in data['transactions']:
-                self.add_transaction(
-                    datetime.strptime(trans['date'], '%Y-%m-%d').date(),
-                    float(trans['amount']),
-                    trans['category'],
-                    trans['description']
-                )
+            # Backups are SQLite snapshots; older ones are JSON documents
+            if decrypted_data.startswith(SQLITE_HEADER):
+                self._restore_snapshot(decrypted_data)
+            else:
+                self._restore_json(json.loads(decrypted_data))
                 
             return True
         except Exception as e:
             print(f"Error importing backup: {str(e)}")
             return False
 
+    def _restore_snapshot(self, snapshot):
+        """Replace this user's data with the rows of a decrypted SQLite snapshot"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_path = os.path.join(tmp_dir, "snapshot.db")
+            with open(snapshot_path, 'wb') as f:
+                f.write(snapshot)
+            
+            with self._lock:
+                self.conn.execute("ATTACH DATABASE ? AS snapshot", (snapshot_path,))
+                try:
+                    # Rows are copied still encrypted, in a single transaction
+                    with self.conn:
+                        c = self.conn.cursor()
+                        c.execute("DELETE FROM salary WHERE user_id = ?", (self.user_id,))
+                        c.execute("DELETE FROM transactions WHERE user_id = ?", (self.user_id,))
+                        c.execute("""
+                            INSERT INTO salary (user_id, amount_encrypted, updated_at)
+                            SELECT ?, amount_encrypted, updated_at FROM snapshot.salary
+                        """, (self.user_id,))
+                        c.execute("""
+                            INSERT INTO transactions 
+                            (user_id, date, amount_encrypted, category, description_encrypted, created_at)
+                            SELECT ?, date, amount_encrypted, category, description_encrypted, created_at
+                            FROM snapshot.transactions ORDER BY id
+                        """, (self.user_id,))
+                finally:
+                    self.conn.execute("DETACH DATABASE snapshot")
+
+    def _restore_json(self, data):
+        """Replace this user's data with the contents of a legacy JSON backup"""
+        # Encrypt all rows up front with the shared cipher; dates are
+        # already ISO strings, which is exactly how the DATE column stores them
+        encrypt_amount = self.auth_manager.encrypt_amount
+        encrypt_data = self.auth_manager.encrypt_data
+        rows = [
+            (self.user_id,
+             trans['date'],
+             encrypt_amount(float(trans['amount'])),
+             trans['category'],
+             encrypt_data(trans['description']))
+            for trans in data['transactions']
+        ]
+        
+        # Replace this user's data in a single transaction
+        with self._lock, self.conn:
+            c = self.conn.cursor()
+            c.execute("DELETE FROM salary WHERE user_id = ?", (self.user_id,))
+            c.execute("DELETE FROM transactions WHERE user_id = ?", (self.user_id,))
+            
+            if data['salary']:
+                c.execute("INSERT INTO salary (user_id, amount_encrypted) VALUES (?, ?)", 
+                         (self.user_id, encrypt_amount(float(data['salary']))))
+            
+            c.executemany("""
+                INSERT INTO transactions 
+                (user_id, date, amount_encrypted, category, description_encrypted)
+                VALUES (?, ?, ?, ?, ?)
+            """, rows)
+
     def list_backups(self):
         """List all available database backups for the current user"""
         if not self.user_id:
             raise ValueError("User not authenticated")
             
-        backups = []
-        for file in os.listdir(self.backup_dir):
-            if file.startswith(f"budget_backup_{self.user_id}_"):
-                backup_path = os.path.join(self.backup_dir, file)
-                backup_time = datetime.fromtimestamp(os.path.getmtime(backup_path))
-                backups.append({
-                    'filename': file,
-                    'path': backup_path,
-                    'created_at': backup_time
-                })
-        return sorted(backups, key=lambda x: x['created_at'], reverse=True)
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute("""
+                SELECT filename, path, created_at FROM backups
+                WHERE user_id = ? ORDER BY created_at DESC
+            """, (self.user_id,))
+            rows = c.fetchall()
+        
+        return [
+            {'filename': filename, 'path': path, 'created_at': datetime.fromisoformat(created_at)}
+            for filename, path, created_at in rows
+        ]